@@ -27,8 +27,11 @@ class ChannelLogger(abstract.ChannelWatcher):
     def __init__(self, bot, channel, config):
         super(ChannelLogger, self).__init__(bot, channel, config)
         name = channel.lstrip("#")
+        use_json = bot.config["Logging"].get("json", False)
         use_yaml = bot.config["Logging"].get("yaml", True)
-        if use_yaml:
+        if use_json:
+            name += ".jsonl"
+        elif use_yaml:
             name += ".yaml"
         else:
             name += ".txt"
@@ -48,7 +51,10 @@ class ChannelLogger(abstract.ChannelWatcher):
                 os.makedirs(log_dir)
             log_handler = log.TimedRotatingFileHandler(os.path.join(
                 log_dir, name), when="midnight")
-            if use_yaml:
+            if use_json:
+                log_handler.setFormatter(log.json_formatter)
+                log_handler.namer = log.json_namer
+            elif use_yaml:
                 log_handler.setFormatter(log.yaml_formatter)
                 log_handler.namer = log.yaml_namer
             else:
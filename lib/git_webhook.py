@@ -15,25 +15,33 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from twisted.web.resource import Resource
-from twisted.internet import reactor, defer
+from twisted.web.server import NOT_DONE_YET
+from twisted.internet import reactor, defer, threads
 from twisted.python.failure import Failure
 from twisted.logger import Logger
 import treq
-import codecs
-import json
+try:
+    import orjson as json
+except ImportError:
+    import json
 import hmac
-from hashlib import sha1
 import re
-import sys
+from functools import lru_cache
 from unidecode import unidecode
 
-from util.formatting import colored, closest_irc_color, split_rgb_string,\
+from util.formatting import closest_irc_color, split_rgb_string,\
     good_contrast_with_black
+from util import formatting
 from util.misc import str_to_bytes, bytes_to_str, filter_dict
 from util.internet import shorten_github_url
 from lib import webhook_actions
 
 
+# repository, branch and user names repeat a lot between events, don't
+# rebuild the same colored strings every time
+colored = lru_cache(maxsize=4096)(formatting.colored)
+
+
 class GitWebhookServer(Resource):
     """
     HTTP(S) Server for GitHub/Gitlab webhooks
@@ -41,11 +49,34 @@ class GitWebhookServer(Resource):
     isLeaf = True
     log = Logger()
     GH_ReviewFloodPrevention_Delay = 10
+    # action -> (displayed text, color or None)
+    _GH_ISSUE_ACTIONS = {"opened": ("opened", "red"),
+                         "reopened": ("reopened", "red"),
+                         "closed": ("closed", "dark_green")}
+    _GH_PR_ACTIONS = {"opened": ("opened", "dark_green"),
+                      "reopened": ("reopened", "dark_green"),
+                      "synchronize": ("synchronized", None),
+                      "ready_for_review": ("marked ready for review:", None)}
+    _GITLAB_ISSUE_ACTIONS = {"open": ("opened", "red"),
+                             "reopen": ("reopened", "red"),
+                             "close": ("closed", "dark_green"),
+                             "update": ("updated", None)}
+    _GITLAB_MR_ACTIONS = {"open": ("opened", "dark_green"),
+                          "reopen": ("reopened", "dark_green"),
+                          "close": ("closed", "red"),
+                          "merge": ("merged", "dark_green"),
+                          "update": ("updated", None),
+                          "approved": ("approved", "dark_green")}
 
     def __init__(self, bot, config):
         self.bot = bot
-        self.github_secret = config["GitWebhook"].get("github_secret", None)
-        self.gitlab_secret = config["GitWebhook"].get("gitlab_secret", None)
+        # secrets are only ever used as bytes, encode them once
+        github_secret = config["GitWebhook"].get("github_secret", None)
+        gitlab_secret = config["GitWebhook"].get("gitlab_secret", None)
+        self.github_secret = str_to_bytes(github_secret) if github_secret \
+            else None
+        self.gitlab_secret = str_to_bytes(gitlab_secret) if gitlab_secret \
+            else None
         self.channels = config["GitWebhook"]["channels"]
         # filter settings
         self.filter_rules = config["GitWebhook"].get("FilterRules", [])
@@ -67,56 +98,103 @@ class GitWebhookServer(Resource):
                           "'hook_report_users', but got a single string")
             users = [users]
         self.hook_report_users = users
+        # (service, eventtype) -> handler, e.g. ("github", "push")
+        self._handlers = {}
+        for name in dir(self):
+            if name.startswith("on_github_") or name.startswith("on_gitlab_"):
+                service, _, eventtype = name[3:].partition("_")
+                self._handlers[(service, eventtype)] = getattr(self, name)
+        # repository id -> (colored name, name)
+        self._repo_colored = {}
 
     def render_POST(self, request):
+        github_event = request.getHeader(b"X-GitHub-Event")
+        gitlab_event = request.getHeader(b"X-Gitlab-Event")
+        # neither GitHub nor Gitlab: not implemented, don't touch the body
+        if not (github_event or gitlab_event):
+            request.setResponseCode(403)
+            return b""
         body = request.content.read()
-        data = json.loads(bytes_to_str(body))
-        service = None
         # GitHub
-        if request.getHeader(b"X-GitHub-Event"):
-            eventtype = request.getHeader(b"X-GitHub-Event")
+        if github_event:
+            # header values are ASCII
+            eventtype = github_event.decode("ascii")
             sig = request.getHeader(b"X-Hub-Signature")
             if sig:
                 sig = sig[5:]
             service = "github"
+            secret = self.github_secret
         # Gitlab
-        elif request.getHeader(b"X-Gitlab-Event"):
-            eventtype = data["object_kind"]
+        else:
+            eventtype = None
             sig = request.getHeader(b"X-Gitlab-Token")
             service = "gitlab"
-        # other: not implemented
-        else:
-            request.setResponseCode(403)
-            return b""
-        eventtype = bytes_to_str(eventtype)
-
-        secret = None
-        if service == "github":
-            secret = self.github_secret
-        elif service == "gitlab":
             secret = self.gitlab_secret
-        if secret:
-            secret = str_to_bytes(secret)
-            h = hmac.new(secret, body, sha1)
-            if codecs.encode(h.digest(), "hex") != sig:
-                self.log.warn("Request's signature does not correspond"
-                              " with the given secret - ignoring request")
-                request.setResponseCode(200)
-                return b""
+
+        if secret and not self.valid_signature(secret, body, sig):
+            self.log.warn("Request's signature does not correspond"
+                          " with the given secret - ignoring request")
+            request.setResponseCode(200)
+            return b""
+        # non-empty once the client went away, the request can't be
+        # finished then
+        lost = []
+        request.notifyFinish().addErrback(lost.append)
+        # large push payloads would block the reactor while being parsed
+        d = threads.deferToThread(json.loads, body)
+        d.addCallback(self._dispatch_event, request, lost, service, eventtype)
+        d.addErrback(self._on_dispatch_error, request, lost)
+        return NOT_DONE_YET
+
+    def _dispatch_event(self, data, request, lost, service, eventtype):
+        if service == "gitlab":
+            eventtype = data["object_kind"]
         # filtering: inject eventtype for filtering
         data["eventtype"] = eventtype
         if self.filter_event(data):
             self.log.debug("filtering out event {event}", event=data)
-        elif hasattr(self, "on_{}_{}".format(service, eventtype)):
-            reactor.callLater(0, getattr(self, "on_{}_{}".format(service,
-                                                                 eventtype)),
-                              data)
+        elif (service, eventtype) in self._handlers:
+            d = defer.maybeDeferred(self._handlers[(service, eventtype)], data)
+            d.addErrback(self._on_handler_error, service, eventtype)
         else:
             self.log.warn("Event {eventtype} not implemented for service "
                           "{service}", eventtype=eventtype, service=service)
         # always return 200
-        request.setResponseCode(200)
-        return b""
+        self._finish(request, lost, 200)
+
+    def _on_handler_error(self, failure, service, eventtype):
+        self.log.error("Error when handling {service} event {eventtype}: "
+                       "{e}", service=service, eventtype=eventtype, e=failure)
+
+    def _on_dispatch_error(self, failure, request, lost):
+        self.log.error("Error when handling a webhook request: {e}",
+                       e=failure)
+        self._finish(request, lost, 500)
+
+    @staticmethod
+    def _finish(request, lost, code):
+        """Answer a deferred request with code, unless it was already
+        answered or the client went away in the meantime"""
+        # finishing a request whose connection was lost raises RuntimeError
+        if request.finished or lost:
+            return
+        request.setResponseCode(code)
+        request.finish()
+
+    @staticmethod
+    def valid_signature(secret, body, sig):
+        """
+        Returns True if sig is the hex encoded sha1 HMAC of body
+        """
+        # a sha1 hex digest is always 40 characters long, there is no need
+        # to hash the whole body for anything else
+        if not sig or len(sig) != 40:
+            return False
+        try:
+            sig = bytes.fromhex(bytes_to_str(sig))
+        except ValueError:
+            return False
+        return hmac.compare_digest(hmac.digest(secret, body, "sha1"), sig)
 
     def filter_event(self, data):
         """
@@ -124,6 +202,32 @@ class GitWebhookServer(Resource):
         """
         return any(filter_dict(data, rule) for rule in self.filter_rules)
 
+    def _repo_tag(self, repo, rid=None):
+        """
+        Returns the colored name of a repository, cached by repository id,
+        pass rid for repository objects without an id
+        """
+        if rid is None:
+            rid = repo["id"]
+        name = repo["name"]
+        cached = self._repo_colored.get(rid)
+        # compare the name, the repository might have been renamed
+        if cached and cached[1] == name:
+            return cached[0]
+        tag = colored(name, "blue")
+        self._repo_colored[rid] = (tag, name)
+        return tag
+
+    @staticmethod
+    def _format_action(actions, action):
+        """
+        Returns the displayed (and maybe colored) text for action
+        """
+        if action not in actions:
+            return action
+        text, color = actions[action]
+        return colored(text, color) if color else text
+
     def github_label_colors(self, label):
         color = label["color"]
         try:
@@ -141,12 +245,11 @@ class GitWebhookServer(Resource):
         """
         Send a success or fail message to the 'hook_report_users'
         """
+        name = colored(actionname, "blue")
         if isinstance(success, Failure):
-            message = "Hook {} failed: {}".format(colored(actionname, "blue"),
-                                                  success.getErrorMessage())
+            message = f"Hook {name} failed: {success.getErrorMessage()}"
         else:
-            message = "Hook {} finished without errors".format(
-                colored(actionname, "blue"))
+            message = f"Hook {name} finished without errors"
         for user in self.hook_report_users:
             self.bot.msg(user, message)
 
@@ -228,23 +331,25 @@ class GitWebhookServer(Resource):
 
     @defer.inlineCallbacks
     def commits_to_irc(self, repo_name, commits, github=False):
-        for i, commit in enumerate(commits):
-            if i == 3:
-                self.report_to_irc(repo_name, "+{} more commits".format(
-                    len(commits) - 3))
-                break
-            if github:
-                url = yield shorten_github_url(commit["url"])
-            else:
-                url = commit["url"]
-            message = unidecode(commit["message"].split("\n")[0])
+        head = commits[:3]
+        if github:
+            results = yield defer.DeferredList(
+                [shorten_github_url(commit["url"]) for commit in head])
+            urls = [res[1] for res in results]
+        else:
+            urls = [commit["url"] for commit in head]
+        for commit, url in zip(head, urls):
+            message = unidecode(commit["message"].partition("\n")[0])
             if len(message) > 100:
                 message = message[:100] + "..."
-            self.report_to_irc(repo_name, "{author}: {message} ({url})".format(
-                author=colored(unidecode(commit["author"]["name"]),
-                               "dark_cyan"),
-                message=message,
-                url=url))
+            author = colored(unidecode(commit["author"]["name"]), "dark_cyan")
+            self.report_to_irc(repo_name, f"{author}: {message} ({url})")
+        if len(commits) > 3:
+            self.report_to_irc(repo_name, f"+{len(commits) - 3} more commits")
+
+    def _on_commits_error(self, failure, repo_name):
+        self.log.error("Reporting commits of repo [{repo}] failed: {e}",
+                       repo=repo_name, e=failure)
 
     @defer.inlineCallbacks
     def on_github_push(self, data):
@@ -256,17 +361,14 @@ class GitWebhookServer(Resource):
         url = yield shorten_github_url(data["compare"])
         repo_name = data["repository"]["name"]
         branch = data["ref"].split("/", 2)[-1]
-        msg = ("[{repo_name}] {pusher} {action} {num_commits} commit(s) to "
-               "{branch}: {compare}".format(
-                   repo_name=colored(repo_name, "blue"),
-                   pusher=colored(unidecode(data["pusher"]["name"]),
-                                  "dark_cyan"),
-                   action=action,
-                   num_commits=len(data["commits"]),
-                   branch=colored(branch, "dark_green"),
-                   compare=url))
+        repo = self._repo_tag(data["repository"])
+        pusher = colored(unidecode(data["pusher"]["name"]), "dark_cyan")
+        num_commits = len(data["commits"])
+        msg = (f"[{repo}] {pusher} {action} {num_commits} commit(s) to "
+               f"{colored(branch, 'dark_green')}: {url}")
         self.report_to_irc(repo_name, msg)
-        self.commits_to_irc(repo_name, data["commits"], github=True)
+        d = self.commits_to_irc(repo_name, data["commits"], github=True)
+        d.addErrback(self._on_commits_error, repo_name)
         # subset of information that is common for both GitHUb and GitLab
         # only a few useful pieces of information
         subset = {"commits": data["commits"],
@@ -292,88 +394,74 @@ class GitWebhookServer(Resource):
         elif action == "labeled" or action == "unlabeled":
             url = yield shorten_github_url(data["issue"]["html_url"])
             fg, bg = self.github_label_colors(data["label"])
-            payload = "{} ({})".format(colored(data["label"]["name"],
-                                               fg, bg), url)
+            payload = f"{colored(data['label']['name'], fg, bg)} ({url})"
         elif action == "milestoned":
             payload = data["issue"]["milestone"]["title"]
-        elif action == "opened":
-            action = colored(action, "red")
-        elif action == "reopened":
-            action = colored(action, "red")
-        elif action == "closed":
-            action = colored(action, "dark_green")
+        else:
+            action = self._format_action(self._GH_ISSUE_ACTIONS, action)
         if not payload:
             payload = yield shorten_github_url(data["issue"]["html_url"])
-        msg = ("[{repo_name}] {user} {action} Issue #{number} {title}: "
-               "{payload}".format(repo_name=colored(repo_name, "blue"),
-                                  user=colored(data["sender"]["login"],
-                                               "dark_cyan"),
-                                  action=action,
-                                  number=colored(str(data["issue"]["number"]),
-                                                 "dark_yellow"),
-                                  title=unidecode(data["issue"]["title"]),
-                                  payload=payload))
+        repo = self._repo_tag(data["repository"])
+        user = colored(data["sender"]["login"], "dark_cyan")
+        number = colored(str(data["issue"]["number"]), "dark_yellow")
+        title = unidecode(data["issue"]["title"])
+        msg = f"[{repo}] {user} {action} Issue #{number} {title}: {payload}"
         self.report_to_irc(repo_name, msg)
 
     @defer.inlineCallbacks
     def on_github_issue_comment(self, data):
         url = yield shorten_github_url(data["comment"]["html_url"])
         repo_name = data["repository"]["name"]
-        msg = ("[{repo_name}] {user} {action} comment on Issue #{number} "
-               "{title} {url}".format(
-                   repo_name=colored(repo_name, "blue"),
-                   user=colored(data["comment"]["user"]["login"], "dark_cyan"),
-                   action=data["action"],
-                   number=colored(str(data["issue"]["number"]), "dark_yellow"),
-                   title=unidecode(data["issue"]["title"]),
-                   url=url))
+        repo = self._repo_tag(data["repository"])
+        user = colored(data["comment"]["user"]["login"], "dark_cyan")
+        action = data["action"]
+        number = colored(str(data["issue"]["number"]), "dark_yellow")
+        title = unidecode(data["issue"]["title"])
+        msg = (f"[{repo}] {user} {action} comment on Issue #{number} {title} "
+               f"{url}")
         self.report_to_irc(repo_name, msg)
 
     def on_github_create(self, data):
         repo_name = data["repository"]["name"]
-        msg = "[{repo_name}] {user} created {ref_type} {ref}".format(
-            repo_name=colored(repo_name, "blue"),
-            user=colored(data["sender"]["login"], "dark_cyan"),
-            ref_type=data["ref_type"],
-            ref=colored(data["ref"], "dark_magenta"))
+        repo = self._repo_tag(data["repository"])
+        user = colored(data["sender"]["login"], "dark_cyan")
+        ref_type = data["ref_type"]
+        ref = colored(data["ref"], "dark_magenta")
+        msg = f"[{repo}] {user} created {ref_type} {ref}"
         self.report_to_irc(repo_name, msg)
 
     def on_github_delete(self, data):
         repo_name = data["repository"]["name"]
-        msg = "[{repo_name}] {user} deleted {ref_type} {ref}".format(
-            repo_name=colored(repo_name, "blue"),
-            user=colored(data["sender"]["login"], "dark_cyan"),
-            ref_type=data["ref_type"],
-            ref=colored(data["ref"], "dark_magenta"))
+        repo = self._repo_tag(data["repository"])
+        user = colored(data["sender"]["login"], "dark_cyan")
+        ref_type = data["ref_type"]
+        ref = colored(data["ref"], "dark_magenta")
+        msg = f"[{repo}] {user} deleted {ref_type} {ref}"
         self.report_to_irc(repo_name, msg)
 
     @defer.inlineCallbacks
     def on_github_fork(self, data):
         repo_name = data["repository"]["name"]
         url = yield shorten_github_url(data["forkee"]["html_url"])
-        msg = "[{repo_name}] {user} created fork {url}".format(
-            repo_name=colored(repo_name, "blue"),
-            user=colored(data["forkee"]["owner"]["login"], "dark_cyan"),
-            url=url)
+        repo = self._repo_tag(data["repository"])
+        user = colored(data["forkee"]["owner"]["login"], "dark_cyan")
+        msg = f"[{repo}] {user} created fork {url}"
         self.report_to_irc(repo_name, msg)
 
     @defer.inlineCallbacks
     def on_github_commit_comment(self, data):
         repo_name = data["repository"]["name"]
         url = yield shorten_github_url(data["comment"]["html_url"])
-        msg = "[{repo_name}] {user} commented on commit {url}".format(
-            repo_name=colored(repo_name, "blue"),
-            user=colored(data["comment"]["user"]["login"], "dark_cyan"),
-            url=url)
+        repo = self._repo_tag(data["repository"])
+        user = colored(data["comment"]["user"]["login"], "dark_cyan")
+        msg = f"[{repo}] {user} commented on commit {url}"
         self.report_to_irc(repo_name, msg)
 
     @defer.inlineCallbacks
     def on_github_release(self, data):
         repo_name = data["repository"]["name"]
         url = yield shorten_github_url(data["release"]["html_url"])
-        msg = "[{repo_name}] New release {url}".format(
-            repo_name=colored(data["repository"]["name"], "blue"),
-            url=url)
+        msg = f"[{self._repo_tag(data['repository'])}] New release {url}"
         self.report_to_irc(repo_name, msg)
 
     @defer.inlineCallbacks
@@ -382,67 +470,53 @@ class GitWebhookServer(Resource):
         payload = None
         repo_name = data["repository"]["name"]
         user = data["sender"]["login"]
+        pr = data["pull_request"]
         if action == "assigned" or action == "unassigned":
-            payload = data["pull_request"]["assignee"]["login"]
+            payload = pr["assignee"]["login"]
         elif action == "labeled" or action == "unlabeled":
-            url = yield shorten_github_url(data["pull_request"]["html_url"])
+            url = yield shorten_github_url(pr["html_url"])
             fg, bg = self.github_label_colors(data["label"])
-            payload = "{} ({})".format(colored(data["label"]["name"],
-                                               fg, bg), url)
+            payload = f"{colored(data['label']['name'], fg, bg)} ({url})"
         elif action == "milestoned":
-            payload = data["pull_request"]["milestone"]["title"]
+            payload = pr["milestone"]["title"]
         elif action == "review_requested":
             action = "requested review for"
             payload = data["requested_reviewer"]["login"]
         elif action == "review_request_removed":
             action = "removed review request for"
             payload = data["requested_reviewer"]["login"]
-        elif action == "opened":
-            action = colored(action, "dark_green")
-        elif action == "reopened":
-            action = colored(action, "dark_green")
         elif action == "closed":
-            if data["pull_request"]["merged"]:
+            if pr["merged"]:
                 action = colored("merged", "dark_green")
-                user = data["pull_request"]["merged_by"]["login"]
+                user = pr["merged_by"]["login"]
             else:
                 action = colored(action, "red")
-        elif action == "synchronize":
-            action = "synchronized"
-        elif action == "ready_for_review":
-            action = "marked ready for review:"
+        else:
+            action = self._format_action(self._GH_PR_ACTIONS, action)
         if not payload:
-            payload = yield shorten_github_url(
-                data["pull_request"]["html_url"])
-        msg = ("[{repo_name}] {user} {action} Pull Request #{number} {title} "
-               "({head} -> {base}): {payload}".format(
-                   repo_name=colored(repo_name, "blue"),
-                   user=colored(user, "dark_cyan"),
-                   action=action,
-                   number=colored(str(data["pull_request"]["number"]),
-                                  "dark_yellow"),
-                   title=unidecode(data["pull_request"]["title"]),
-                   head=colored(data["pull_request"]["head"]["ref"],
-                                "dark_blue"),
-                   base=colored(data["pull_request"]["base"]["ref"],
-                                "dark_red"),
-                   payload=payload))
+            payload = yield shorten_github_url(pr["html_url"])
+        repo = self._repo_tag(data["repository"])
+        user = colored(user, "dark_cyan")
+        number = colored(str(pr["number"]), "dark_yellow")
+        title = unidecode(pr["title"])
+        head = colored(pr["head"]["ref"], "dark_blue")
+        base = colored(pr["base"]["ref"], "dark_red")
+        msg = (f"[{repo}] {user} {action} Pull Request #{number} {title} "
+               f"({head} -> {base}): {payload}")
         self.report_to_irc(repo_name, msg)
 
     def _github_PR_review_send_msg(self, is_comment, repo_name, user,
                                    pr_number, title, action, head, base, urls):
         type_ = "Review Comment" if is_comment else "Review"
-        msg = ("[{repo_name}] {user} {action} {type_} for Pull Request "
-               "#{number} {title} ({head} -> {base}): {url}".format(
-                   repo_name=colored(repo_name, "blue"),
-                   user=colored(user, "dark_cyan"),
-                   action=action,
-                   type_=type_,
-                   number=colored(pr_number, "dark_yellow"),
-                   title=unidecode(title),
-                   head=colored(head, "dark_blue"),
-                   base=colored(base, "dark_red"),
-                   url=", ".join(urls)))
+        repo = colored(repo_name, "blue")
+        user = colored(user, "dark_cyan")
+        number = colored(pr_number, "dark_yellow")
+        title = unidecode(title)
+        head = colored(head, "dark_blue")
+        base = colored(base, "dark_red")
+        url = ", ".join(urls)
+        msg = (f"[{repo}] {user} {action} {type_} for Pull Request "
+               f"#{number} {title} ({head} -> {base}): {url}")
         self.report_to_irc(repo_name, msg)
 
     @defer.inlineCallbacks
@@ -472,9 +546,10 @@ class GitWebhookServer(Resource):
             partition[key].append(event)
         for k, events in partition.items():
             repo_name, pr_number, user, action = k
-            title = events[0]["pull_request"]["title"]
-            head = events[0]["pull_request"]["head"]["ref"]
-            base = events[0]["pull_request"]["base"]["ref"]
+            pr = events[0]["pull_request"]
+            title = pr["title"]
+            head = pr["head"]["ref"]
+            base = pr["base"]["ref"]
             # remove duplicate urls
             full_urls = {e[type_]["html_url"] for e in events}
             urls_defers = [shorten_github_url(url) for url in full_urls]
@@ -494,16 +569,18 @@ class GitWebhookServer(Resource):
                     GitWebhookServer.GH_ReviewFloodPrevention_Delay,
                     self.github_handle_review_flood, False)
         else:
-            url = yield shorten_github_url(data["review"]["html_url"])
+            item = data["review"]
+            pr = data["pull_request"]
+            url = yield shorten_github_url(item["html_url"])
             self._github_PR_review_send_msg(
                 False,
                 data["repository"]["name"],
-                data["review"]["user"]["login"],
-                data["pull_request"]["number"],
-                data["pull_request"]["title"],
+                item["user"]["login"],
+                pr["number"],
+                pr["title"],
                 data["action"],
-                data["pull_request"]["head"]["ref"],
-                data["pull_request"]["base"]["ref"],
+                pr["head"]["ref"],
+                pr["base"]["ref"],
                 [url])
 
     @defer.inlineCallbacks
@@ -516,29 +593,31 @@ class GitWebhookServer(Resource):
                     GitWebhookServer.GH_ReviewFloodPrevention_Delay,
                     self.github_handle_review_flood, True)
         else:
-            url = yield shorten_github_url(data["comment"]["html_url"])
+            item = data["comment"]
+            pr = data["pull_request"]
+            url = yield shorten_github_url(item["html_url"])
             self._github_PR_review_send_msg(
                 True,
                 data["repository"]["name"],
-                data["comment"]["user"]["login"],
-                data["pull_request"]["number"],
-                data["pull_request"]["title"],
+                item["user"]["login"],
+                pr["number"],
+                pr["title"],
                 data["action"],
-                data["pull_request"]["head"]["ref"],
-                data["pull_request"]["base"]["ref"],
+                pr["head"]["ref"],
+                pr["base"]["ref"],
                 [url])
 
     def on_gitlab_push(self, data):
         repo_name = data["project"]["name"]
         branch = data["ref"].split("/", 2)[-1]
-        msg = ("[{repo_name}] {pusher} pushed {num_commits} commit(s) to "
-               "{branch}".format(repo_name=colored(repo_name, "blue"),
-                                 pusher=colored(data["user_name"],
-                                                "dark_cyan"),
-                                 num_commits=len(data["commits"]),
-                                 branch=colored(branch, "dark_green")))
+        repo = self._repo_tag(data["project"])
+        pusher = colored(data["user_name"], "dark_cyan")
+        num_commits = len(data["commits"])
+        msg = (f"[{repo}] {pusher} pushed {num_commits} commit(s) to "
+               f"{colored(branch, 'dark_green')}")
         self.report_to_irc(repo_name, msg)
-        self.commits_to_irc(repo_name, data["commits"])
+        d = self.commits_to_irc(repo_name, data["commits"])
+        d.addErrback(self._on_commits_error, repo_name)
         # subset of information that is common for both GitHUb and GitLab
         # only a few useful pieces of information
         subset = {"commits": data["commits"],
@@ -555,33 +634,25 @@ class GitWebhookServer(Resource):
 
     def on_gitlab_tag_push(self, data):
         repo_name = data["project"]["name"]
-        msg = ("[{repo_name}] {pusher} added tag {tag}".format(
-            repo_name=colored(repo_name, "blue"),
-            pusher=colored(data["user_name"], "dark_cyan"),
-            tag=colored(data["ref"].split("/", 2)[-1], "dark_green")))
+        repo = self._repo_tag(data["project"])
+        pusher = colored(data["user_name"], "dark_cyan")
+        tag = colored(data["ref"].split("/", 2)[-1], "dark_green")
+        msg = f"[{repo}] {pusher} added tag {tag}"
         self.report_to_irc(repo_name, msg)
-        self.commits_to_irc(repo_name, data["commits"])
+        d = self.commits_to_irc(repo_name, data["commits"])
+        d.addErrback(self._on_commits_error, repo_name)
 
     def on_gitlab_issue(self, data):
         repo_name = data["project"]["name"]
         attribs = data["object_attributes"]
-        action = attribs["action"]
-        if action == "open":
-            action = colored("opened", "red")
-        elif action == "reopen":
-            action = colored("reopened", "red")
-        elif action == "close":
-            action = colored("closed", "dark_green")
-        elif action == "update":
-            action = "updated"
-        msg = ("[{repo_name}] {user} {action} Issue #{number} {title} "
-               "{url}".format(repo_name=colored(repo_name, "blue"),
-                              user=colored(data["user"]["name"], "dark_cyan"),
-                              action=action,
-                              number=colored(str(attribs["iid"]),
-                                             "dark_yellow"),
-                              title=unidecode(attribs["title"]),
-                              url=attribs["url"]))
+        action = self._format_action(self._GITLAB_ISSUE_ACTIONS,
+                                     attribs["action"])
+        repo = self._repo_tag(data["project"])
+        user = colored(data["user"]["name"], "dark_cyan")
+        number = colored(str(attribs["iid"]), "dark_yellow")
+        title = unidecode(attribs["title"])
+        url = attribs["url"]
+        msg = f"[{repo}] {user} {action} Issue #{number} {title} {url}"
         self.report_to_irc(repo_name, msg)
 
     def on_gitlab_note(self, data):
@@ -590,7 +661,7 @@ class GitWebhookServer(Resource):
         noteable_type = attribs["noteable_type"]
         if noteable_type == "Commit":
             id = attribs["commit_id"]
-            title = data["commit"]["message"].split("\n")[0]
+            title = data["commit"]["message"].partition("\n")[0]
             if len(title) > 100:
                 title = title[:100] + "..."
         elif noteable_type == "MergeRequest":
@@ -605,40 +676,28 @@ class GitWebhookServer(Resource):
             title = data["snippet"]["title"]
         else:
             return
-        msg = ("[{repo_name}] {user} commented on {noteable_type} {number} "
-               "{title} {url}".format(
-                   repo_name=colored(repo_name, "blue"),
-                   user=colored(data["user"]["name"], "dark_cyan"),
-                   noteable_type=noteable_type,
-                   number=colored(str(id), "dark_yellow"),
-                   title=unidecode(title),
-                   url=attribs["url"]))
+        repo = self._repo_tag(data["project"])
+        user = colored(data["user"]["name"], "dark_cyan")
+        number = colored(str(id), "dark_yellow")
+        title = unidecode(title)
+        url = attribs["url"]
+        msg = (f"[{repo}] {user} commented on {noteable_type} {number} "
+               f"{title} {url}")
         self.report_to_irc(repo_name, msg)
 
     def on_gitlab_merge_request(self, data):
         attribs = data["object_attributes"]
         repo_name = attribs["target"]["name"]
-        action = attribs["action"]
-        if action == "open":
-            action = colored("opened", "dark_green")
-        elif action == "reopen":
-            action = colored("reopened", "dark_green")
-        elif action == "close":
-            action = colored("closed", "red")
-        elif action == "merge":
-            action = colored("merged", "dark_green")
-        elif action == "update":
-            action = "updated"
-        elif action == "approved":
-            action = colored("approved", "dark_green")
-        msg = ("[{repo_name}] {user} {action} Merge Request #{number} "
-               "{title} ({source} -> {target}): {url}".format(
-                   repo_name=colored(repo_name, "blue"),
-                   user=colored(data["user"]["name"], "dark_cyan"),
-                   action=action,
-                   number=colored(str(attribs["iid"]), "dark_yellow"),
-                   title=unidecode(attribs["title"]),
-                   source=colored(attribs["source_branch"], "dark_blue"),
-                   target=colored(attribs["target_branch"], "dark_red"),
-                   url=attribs["url"]))
+        action = self._format_action(self._GITLAB_MR_ACTIONS,
+                                     attribs["action"])
+        # the target project has no id of its own
+        repo = self._repo_tag(attribs["target"], attribs["target_project_id"])
+        user = colored(data["user"]["name"], "dark_cyan")
+        number = colored(str(attribs["iid"]), "dark_yellow")
+        title = unidecode(attribs["title"])
+        source = colored(attribs["source_branch"], "dark_blue")
+        target = colored(attribs["target_branch"], "dark_red")
+        url = attribs["url"]
+        msg = (f"[{repo}] {user} {action} Merge Request #{number} {title} "
+               f"({source} -> {target}): {url}")
         self.report_to_irc(repo_name, msg)
@@ -17,9 +17,9 @@
 from twisted.web.server import Site, NOT_DONE_YET
 from twisted.web.resource import Resource
 from twisted.web.static import File
-from twisted.words.protocols import irc
-from twisted.internet import threads, reactor
-from twisted.internet.task import LoopingCall, deferLater
+from twisted.internet import defer, threads, reactor
+from twisted.internet.task import LoopingCall, deferLater, cooperate, \
+    TaskStopped
 from twisted.logger import Logger
 
 from whoosh.index import create_in
@@ -27,11 +27,28 @@ from whoosh import fields, highlight
 from whoosh.qparser import QueryParser
 
 import yaml
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+import io
 import os
 import re
+try:
+    # linear time matching for the urls in every logged message
+    import re2 as re_urls
+except ImportError:
+    import re as re_urls
+import json
+import pickle
+import shutil
+import tempfile
 import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from itertools import groupby
+from string import Formatter
 from html import escape as htmlescape
 
 from util import log, formatting
@@ -46,9 +63,23 @@ LEVEL_ALL = 10
 LEVEL_MOST = 11
 LEVEL_IMPORTANT = 16
 
-date_regex = re.compile(r"^(19|20)\d\d[- /.](0[1-9]|1[012])[- /.](0[1-9]|"
-                        r"[12][0-9]|3[01])$")
-url_pat = re.compile(r"(((https?)|(ftps?)|(sftp))://[^\s\"\')]+)")
+# use with fullmatch
+date_regex = re.compile(r"(19|20)\d\d[- /.](0[1-9]|1[012])[- /.](0[1-9]|"
+                        r"[12][0-9]|3[01])")
+# urls end at IRC formatting control characters
+url_pat = re_urls.compile(r"(?:https?|ftps?|sftp)://[^\s\"\')\x00-\x1f]+")
+# IRC colors and text attributes, for indexing messages without formatting
+irc_format_pat = re.compile(r"\x03(?:\d{1,2}(?:,\d{1,2})?)?|"
+                            r"[\x02\x1f\x16\x0f\x1d]")
+
+# extensions of channel log files, in order of preference
+LOG_EXTENSIONS = (".jsonl", ".yaml")
+# number of log rows written to a response at once
+ROWS_PER_CHUNK = 500
+# number of threads parsing logs when building the search index
+INDEX_PARSER_THREADS = min(8, os.cpu_count() or 1)
+# bump when the format of the cached search fields changes
+FIELDS_CACHE_VERSION = 1
 
 line_templates = defaultdict(str, {
     "MSG": '<tr><td class="time"><span id="{index}"></span><a href="#{index}">'
@@ -81,10 +112,36 @@ line_templates = defaultdict(str, {
              '<a href="#{index}">{time}</a></td><td class="user"><span'
              ' style="color:#FF0000">ERROR</span></td><td>{msg}</td></tr>'})
 
+# levelname -> function formatting a (prepared) log record as table row,
+# takes the record itself as mapping instead of unpacking it into kwargs
+line_formatters = defaultdict(lambda: "".format_map, {
+    name: template.format_map for name, template in line_templates.items()})
 
-base_page_template = fs.get_contents("resources/base_page_template.html")
+
+class PageTemplate(object):
+    """A str.format template with plain {name} fields, which is parsed
+    once instead of on every format call"""
+    def __init__(self, template):
+        self.parts = [(literal, field) for literal, field, _, _ in
+                      Formatter().parse(template)]
+
+    def format(self, **kwargs):
+        out = []
+        for literal, field in self.parts:
+            out.append(literal)
+            if field is not None:
+                out.append(str(kwargs[field]))
+        return "".join(out)
+
+
+base_page_template = PageTemplate(
+    fs.get_contents("resources/base_page_template.html"))
 log_page_template = fs.get_contents("resources/log_page_template.html")
-search_page_template = fs.get_contents("resources/search_page_template.html")
+# the log is written between these two, so it can be streamed
+log_page_head, log_page_tail = map(PageTemplate,
+                                   log_page_template.split("{log_data}"))
+search_page_template = PageTemplate(
+    fs.get_contents("resources/search_page_template.html"))
 header = fs.get_contents("resources/header.inc")
 footer = fs.get_contents("resources/footer.inc")
 
@@ -97,16 +154,90 @@ def _onError(failure, request):
         request.finish()
 
 
-def _prepare_yaml_element(element):
-    """Prepare a yaml element for display in html"""
-    element["time"] = element["time"][11:]
-    for key, val in element.items():
-        if isinstance(element[key], str):
-            element[key] = htmlescape(val)
-    if "message" in element:
-        element["message"] = formatting.to_html(element["message"])
-        element["message"] = url_pat.sub(r"<a href='\1'>\1</a>",
-                                         element["message"])
+def _load_log(logfile, name):
+    """Iterate over the records of an open channel log file"""
+    if name.endswith(".jsonl"):
+        return (json.loads(line) for line in logfile if line.strip())
+    return yaml.load_all(logfile, Loader=_Loader)
+
+
+def find_log_file(log_dir, basename):
+    """Return the path of a channel log (without extension) in log_dir,
+    None if it doesn't exist"""
+    for ext in LOG_EXTENSIONS:
+        path = os.path.join(log_dir, basename + ext)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def escape_and_linkify(text):
+    """HTML escape text and turn urls into links in a single pass"""
+    parts = []
+    last = 0
+    for match in url_pat.finditer(text):
+        start, end = match.span()
+        parts.append(htmlescape(text[last:start]))
+        url = htmlescape(match.group(0))
+        parts.append("<a href='{0}'>{0}</a>".format(url))
+        last = end
+    parts.append(htmlescape(text[last:]))
+    return "".join(parts)
+
+
+def _preparer(*escaped, message=False):
+    """Return a function preparing a log record for display in html, which
+    escapes the given fields and formats the message if there is one"""
+    def prepare(element):
+        # "%Y-%m-%d_%H:%M:%S", only the time of day is shown
+        t = element["time"]
+        element["time"] = t[11:] if len(t) > 11 else t
+        for key in escaped:
+            element[key] = htmlescape(element[key])
+        if message:
+            # links never contain IRC formatting characters, so converting
+            # them to html afterwards can't split a link
+            element["message"] = formatting.to_html(
+                escape_and_linkify(element["message"]))
+    return prepare
+
+
+# levelname -> function preparing a log record for its line formatter
+line_preparers = defaultdict(lambda: lambda element: None, {
+    "MSG": _preparer("user", message=True),
+    "ACTION": _preparer("user", "data"),
+    "NOTICE": _preparer("user", message=True),
+    "KICK": _preparer("kickee", "kicker", message=True),
+    "QUIT": _preparer("user", "quitMessage"),
+    "PART": _preparer("user"),
+    "JOIN": _preparer("user"),
+    "NICK": _preparer("oldnick", "newnick"),
+    "TOPIC": _preparer("user", "topic"),
+    "ERROR": _preparer("msg")})
+
+
+def log_rows(path, min_level):
+    """Iterate over the html table rows of the records of a channel log
+    above min_level"""
+    with open(path) as logfile:
+        for i, data in enumerate(_load_log(logfile, path)):
+            if data["levelno"] > min_level:
+                levelname = data["levelname"]
+                line_preparers[levelname](data)
+                data["index"] = i
+                yield line_formatters[levelname](data)
+
+
+def log_chunks(path, min_level):
+    """Iterate over the html table of a channel log in chunks of rows"""
+    rows = ['<table>']
+    for row in log_rows(path, min_level):
+        rows.append(row)
+        if len(rows) >= ROWS_PER_CHUNK:
+            yield "".join(rows)
+            rows = []
+    rows.append('</table>')
+    yield "".join(rows)
 
 
 def add_resources_to_root(root):
@@ -130,7 +261,7 @@ class BasePage(BaseResource):
         self.title = config["HTTPLogServer"].get("title", "PyTIBot Log Server")
         # add channel logs
         self.channels = config["HTTPLogServer"].get("channels", [])
-        search_pagelen = config["HTTPLogServer"].get("search_pagelen", 5)
+        search_pagelen = config["HTTPLogServer"].get("search_pagelen", 20)
         indexer_procs = config["HTTPLogServer"].get("indexer_procs", 1)
         for channel in self.channels:
             name = channel.lstrip("#")
@@ -159,6 +290,12 @@ class LogPage(BaseResource):
         self.log_dir = log_dir
         self.title = title
         self.singlechannel = singlechannel
+        # rendered pages of past days, templates might have changed since the
+        # last run, so start with an empty directory
+        self.rendered_dir = os.path.join(fs.adirs.user_cache_dir, "rendered",
+                                         self.channel)
+        shutil.rmtree(self.rendered_dir, ignore_errors=True)
+        os.makedirs(self.rendered_dir)
         self.putChild(b"search", SearchPage(self.channel, log_dir, title,
                                             search_pagelen, indexer_procs,
                                             singlechannel=singlechannel))
@@ -171,37 +308,99 @@ class LogPage(BaseResource):
             return ""
         return self.channel
 
+    def _page_parts(self, date, level):
+        """Return the page before and after the log"""
+        kwargs = {"title": self.title, "header": header, "footer": footer,
+                  "channel": self.channel_link(), "date": date,
+                  "Level": level}
+        return (str_to_bytes(log_page_head.format(**kwargs)),
+                str_to_bytes(log_page_tail.format(**kwargs)))
+
+    def _page_chunks(self, path, date, level):
+        """Iterate over the encoded page in chunks"""
+        head, tail = self._page_parts(date, level)
+        yield head
+        if path:
+            for chunk in log_chunks(path, level):
+                yield str_to_bytes(chunk)
+        else:
+            yield b"Log not found"
+        yield tail
+
+    def _write_log(self, request, path, date, level):
+        """Write the page to request, yields after every chunk so other
+        events can be handled in between"""
+        for chunk in self._page_chunks(path, date, level):
+            request.write(chunk)
+            yield
+        request.finish()
+
+    def _render_page(self, path, rendered, date, level):
+        """Write the page of a past day's log to the file rendered, yields
+        after every chunk like _write_log"""
+        # write atomically, the page might be served or rendered by another
+        # request at the same time
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.rendered_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in self._page_chunks(path, date, level):
+                    f.write(chunk)
+                    yield
+            os.replace(tmp, rendered)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    @staticmethod
+    def _serve_file(_, request, lost, rendered):
+        if lost:
+            # the client went away while the page was rendered
+            return
+        res = File(rendered, defaultType="text/html").render_GET(request)
+        if res != NOT_DONE_YET:
+            request.write(res)
+            request.finish()
+
     def _show_log(self, request):
-        log_data = "Log not found"
         MIN_LEVEL = LEVEL_IMPORTANT
         try:
             MIN_LEVEL = int(request.args.get(b"level", [MIN_LEVEL])[0])
         except ValueError as e:
             logger.warn("Got invalid log 'level' in request arguments: "
                         "{level}", level=request.args[b"level"])
-        filename = None
+        basename = None
         date = bytes_to_str(request.args.get(b"date", [b"current"])[0])
-        if date == datetime.today().strftime("%Y-%m-%d"):
-            filename = "{}.yaml".format(self.channel)
-        elif date_regex.match(date):
-            filename = "{}.{}.yaml".format(self.channel, date)
-        elif date == "current":
-            filename = "{}.yaml".format(self.channel)
-            date = datetime.today().strftime("%Y-%m-%d")
-        if filename and os.path.isfile(os.path.join(self.log_dir, filename)):
-            with open(os.path.join(self.log_dir, filename)) as logfile:
-                log_data = '<table>'
-                for i, data in enumerate(yaml.full_load_all(logfile)):
-                    if data["levelno"] > MIN_LEVEL:
-                        _prepare_yaml_element(data)
-                        log_data += line_templates[data["levelname"]].format(
-                            index=i, **data)
-                log_data += '</table>'
-        request.write(str_to_bytes(log_page_template.format(
-            log_data=log_data, title=self.title, header=header,
-            footer=footer, channel=self.channel_link(), date=date,
-            Level=MIN_LEVEL)))
-        request.finish()
+        today = datetime.today().strftime("%Y-%m-%d")
+        if date == "current":
+            date = today
+        if date == today:
+            basename = self.channel
+        elif date_regex.fullmatch(date):
+            basename = "{}.{}".format(self.channel, date)
+        path = find_log_file(self.log_dir, basename) if basename else None
+        # past days don't change anymore, serve them from a file
+        if (path and basename != self.channel and
+                MIN_LEVEL in (LEVEL_ALL, LEVEL_MOST, LEVEL_IMPORTANT)):
+            rendered = os.path.join(self.rendered_dir,
+                                    "{}.{}.html".format(date, MIN_LEVEL))
+            lost = []
+            request.notifyFinish().addErrback(lost.append)
+            if (os.path.isfile(rendered) and
+                    os.path.getmtime(rendered) >= os.path.getmtime(path)):
+                d = defer.succeed(None)
+            else:
+                # render it first, without blocking the reactor, finish
+                # rendering for later requests even if the client goes away
+                d = cooperate(self._render_page(path, rendered, date,
+                                                MIN_LEVEL)).whenDone()
+            d.addCallback(self._serve_file, request, lost, rendered)
+            return d
+        task = cooperate(self._write_log(request, path, date, MIN_LEVEL))
+        # stop writing if the client went away
+        request.notifyFinish().addErrback(lambda _: task.stop())
+        d = task.whenDone()
+        d.addErrback(lambda failure: failure.trap(TaskStopped))
+        return d
 
     def render_GET(self, request):
         d = deferLater(reactor, 0, self._show_log, request)
@@ -221,70 +420,153 @@ class SearchPage(BaseResource):
         self.indexer_procs = indexer_procs
         self.singlechannel = singlechannel
         self.ix = None
+        # today's log name -> (parsed bytes, inode, records so far)
+        self._current_logs = {}
+        # names of the log files that are in the index
+        self._indexed_paths = set()
+        # parsed search fields of the logs, reused across restarts
+        self.fields_cache_dir = os.path.join(fs.adirs.user_cache_dir,
+                                             "fieldscache", channel)
+        os.makedirs(self.fields_cache_dir, exist_ok=True)
         threads.deferToThread(self._setup_index)
 
+    @staticmethod
+    def _messages(records, start=0):
+        """Iterate over (record index, unformatted message) of the messages
+        among log records, start is the index of the first record"""
+        for i, element in enumerate(records, start):
+            if element["levelname"] == "MSG":
+                yield i, irc_format_pat.sub("", element["message"])
+
+    def _current_day_fields(self, name):
+        """Like _fields_from_yaml for today's log, but only returns the
+        messages that were appended since the last call. The last value
+        is True if these are all messages of the log."""
+        path = os.path.join(self.log_dir, name)
+        stat = os.stat(path)
+        offset, inode, count = self._current_logs.get(name, (0, None, 0))
+        # the log wasn't read yet or it was rotated, start over
+        full = stat.st_ino != inode or stat.st_size < offset
+        if full:
+            offset, count = 0, 0
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        # the channel logger writes and flushes every record (a line of
+        # JSON or a multi-line YAML document) in a single call on the
+        # reactor thread, which also runs this, so the file always ends
+        # with a complete record. Cutting at the last newline only guards
+        # against a write that was flushed partially.
+        end = data.rfind(b"\n") + 1
+        records = list(_load_log(io.StringIO(bytes_to_str(data[:end])),
+                                 name))
+        messages = list(self._messages(records, count))
+        self._current_logs[name] = (offset + end, stat.st_ino,
+                                    count + len(records))
+        return messages, datetime.now(), full
+
     def _fields_from_yaml(self, name):
+        """Return the (record index, unformatted message) pairs of a log's
+        messages and the date of the log"""
         path = os.path.join(self.log_dir, name)
+        stat = os.stat(path)
+        key = (FIELDS_CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+        cached = os.path.join(self.fields_cache_dir, name + ".pkl")
+        try:
+            with open(cached, "rb") as f:
+                cached_key, res = pickle.load(f)
+            if cached_key == key:
+                return res
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
         with open(path) as f:
-            content = []
-            for element in yaml.full_load_all(f.read()):
-                if element["levelname"] == "MSG":
-                    msg = irc.stripFormatting(element["message"])
-                    content.append(msg)
-            datestr = name.lstrip(self.channel + ".").rstrip(".yaml")
-            try:
-                date = datetime.strptime(datestr, "%Y-%m-%d")
-            except ValueError:
-                # default to today
-                date = datetime.now()
-            # U+2026 is "horizontal ellipsis"
-            c = u"\u2026 ".join(content)
-        return c, date
+            messages = list(self._messages(_load_log(f, name)))
+        # <channelname>.<date>.<ext>
+        datestr = os.path.splitext(name)[0][len(self.channel) + 1:]
+        try:
+            date = datetime.strptime(datestr, "%Y-%m-%d")
+        except ValueError:
+            # today's log is still growing, don't cache it
+            return messages, datetime.now()
+        tmp = cached + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump((key, (messages, date)), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cached)
+        return messages, date
+
+    @staticmethod
+    def _add_messages(writer, name, messages, date):
+        for lineno, msg in messages:
+            writer.add_document(path=name, content=msg, date=date,
+                                lineno=lineno)
 
     def _setup_index(self):
         schema = fields.Schema(path=fields.ID(stored=True),
                                content=fields.TEXT(stored=True),
                                date=fields.DATETIME(stored=True,
-                                                    sortable=True))
+                                                    sortable=True),
+                               lineno=fields.NUMERIC(stored=True))
         indexpath = os.path.join(fs.adirs.user_cache_dir, "index",
                                  self.channel)
         if not os.path.exists(indexpath):
             os.makedirs(indexpath)
         ix = create_in(indexpath, schema)
-        writer = ix.writer(procs=self.indexer_procs)
-        for name in os.listdir(self.log_dir):
-            if name.startswith(self.channel + ".") and name.endswith(".yaml"):
-                c, date = self._fields_from_yaml(name)
-                writer.add_document(path=name, content=c, date=date)
+        # a full rebuild benefits from large buffers and skipping the final
+        # merge of the sub-writers' segments
+        writer = ix.writer(procs=self.indexer_procs, limitmb=256,
+                           multisegment=True)
+        prefix = self.channel + "."
+        with os.scandir(self.log_dir) as entries:
+            names = [entry.name for entry in entries
+                     if (entry.name.startswith(prefix) and
+                         entry.name.endswith(LOG_EXTENSIONS))]
+        if self.indexer_procs > 1:
+            # the writer forks its worker processes from add_document, which
+            # must not happen while parser threads are running
+            for name in names:
+                messages, date = self._fields_from_yaml(name)
+                self._add_messages(writer, name, messages, date)
+        else:
+            # read and parse the logs in parallel, the writer is only used
+            # from this thread
+            with ThreadPoolExecutor(
+                    max_workers=INDEX_PARSER_THREADS) as executor:
+                for name, (messages, date) in zip(names, executor.map(
+                        self._fields_from_yaml, names)):
+                    self._add_messages(writer, name, messages, date)
         writer.commit()
+        self._indexed_paths.update(names)
         self.last_index_update = time.time()
         self.ix = ix
         lc = LoopingCall(self.update_index)
         reactor.callFromThread(lc.start, 30, now=False)
 
     def update_index(self):
-        with self.ix.searcher() as searcher:
-            writer = self.ix.writer(procs=self.indexer_procs)
-            indexed_paths = set()
-            for field in searcher.all_stored_fields():
-                indexed_paths.add(field["path"])
-        for name in os.listdir(self.log_dir):
-            if name.startswith(self.channel + ".") and name.endswith(".yaml"):
-                if name not in indexed_paths:
-                    c, date = self._fields_from_yaml(name)
-                    writer.add_document(path=name, content=c,
-                                        date=date)
-        # <channelname>.yaml is the only file that can change
-        name = u"{}.yaml".format(self.channel)
-        path = os.path.join(self.log_dir, name)
-        if os.path.isfile(path):
-            modtime = os.path.getmtime(path)
-            if modtime > self.last_index_update:
-                c, date = self._fields_from_yaml(name)
-                if name in indexed_paths:
-                    writer.delete_by_term("path", name)
-                writer.update_document(path=name, content=c, date=date)
+        # updates are small, a single process avoids the pool overhead
+        writer = self.ix.writer(procs=1, limitmb=64)
+        added = set()
+        prefix = self.channel + "."
+        current = {self.channel + ext for ext in LOG_EXTENSIONS}
+        with os.scandir(self.log_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if not (name.startswith(prefix) and
+                        name.endswith(LOG_EXTENSIONS)):
+                    continue
+                # <channelname>.<ext> is the only file that can change
+                if name in current:
+                    if entry.stat().st_mtime > self.last_index_update:
+                        messages, date, full = self._current_day_fields(name)
+                        if full and name in self._indexed_paths:
+                            writer.delete_by_term("path", name)
+                        self._add_messages(writer, name, messages, date)
+                        added.add(name)
+                elif name not in self._indexed_paths:
+                    messages, date = self._fields_from_yaml(name)
+                    self._add_messages(writer, name, messages, date)
+                    added.add(name)
         writer.commit()
+        self._indexed_paths.update(added)
         self.last_index_update = time.time()
 
     def channel_link(self):
@@ -313,20 +595,27 @@ class SearchPage(BaseResource):
             res_page = searcher.search_page(query, page,
                                             pagelen=self.pagelen,
                                             sortedby="date", reverse=True)
-            res_page.results.fragmenter = highlight.SentenceFragmenter(
-                sentencechars=u".!?\u2026", charlimit=None)
-            log_data = ""
-            for hit in res_page:
-                log_data += ("<ul><div><label><a href='{channel}?date="
+            # every document is a single message, highlight all of it
+            res_page.results.fragmenter = highlight.WholeFragmenter(
+                charlimit=None)
+            channel = self.channel_link()
+            parts = []
+            for date, hits in groupby(
+                    res_page, lambda hit: hit["date"].strftime("%Y-%m-%d")):
+                parts.append("<ul><div><label><a href='{channel}?date="
                              "{date}'>{date}</a></label>".format(
-                                 channel=self.channel_link(),
-                                 date=hit["date"].strftime("%Y-%m-%d")) +
-                             hit.highlights("content") +
-                             "</div></ul>")
-            else:
-                if not res_page.is_last_page():
-                    log_data += "<a href='?q={}&page={}'>Next</a>".format(
-                        querystr, page + 1)
+                                 channel=channel, date=date))
+                for hit in sorted(hits, key=lambda hit: hit["lineno"]):
+                    parts.append("<br/><a href='{channel}?date={date}#"
+                                 "{lineno}'>#</a> ".format(
+                                     channel=channel, date=date,
+                                     lineno=hit["lineno"]))
+                    parts.append(hit.highlights("content"))
+                parts.append("</div></ul>")
+            if not res_page.is_last_page():
+                parts.append("<a href='?q={}&page={}'>Next</a>".format(
+                    querystr, page + 1))
+            log_data = "".join(parts)
             if not res_page:
                 log_data = "No Logs found containg: {}".format(
                     htmlescape(querystr))
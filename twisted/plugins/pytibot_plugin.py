@@ -106,7 +106,7 @@ class PyTIBotServiceMaker(object):
                 title = config["HTTPLogServer"].get("title",
                                                     "PyTIBot Log Server")
                 search_pagelen = config["HTTPLogServer"].get("search_pagelen",
-                                                             5)
+                                                             20)
                 indexer_procs = config["HTTPLogServer"].get("indexer_procs", 1)
                 root = LogPage(channels[0], log.get_channellog_dir(config),
                                title, search_pagelen, indexer_procs,
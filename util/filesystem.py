@@ -16,17 +16,18 @@
 
 import appdirs
 import os
+from functools import lru_cache
 import pytibot
 from util.decorators import memoize
 
 
 adirs = appdirs.AppDirs(appname="PyTIBot")
+_BASE_DIR = os.path.dirname(os.path.realpath(pytibot.__file__))
 
 
-@memoize
 def get_base_dir():
     """Return the base directory for this project"""
-    return os.path.dirname(os.path.realpath(pytibot.__file__))
+    return _BASE_DIR
 
 
 @memoize
@@ -48,31 +49,40 @@ def isdir(path):
     return os.path.isdir(get_abs_path(path))
 
 
-@memoize
+def _path_parts(path):
+    """Split a path of the virtual filesystem into its components"""
+    parts = [p for p in path.split("/") if p]
+    if "." in parts or ".." in parts:
+        raise SystemError("Relative paths are not supported")
+    return parts
+
+
+@lru_cache(maxsize=512)
 def get_abs_path(path):
     """Return the absolute path of a file in the virtual filesystem
 
     if there are multiple files/directories with the same virtual path
     the one in adirs.user_data_dir is used"""
-    path = path.split("/")
-    if "." in path or ".." in path:
-        raise SystemError("Relative paths are not supported")
-    while "" in path:
-        path.remove("")
-    if os.path.exists(os.path.join(adirs.user_data_dir, *path)):
-        return os.path.join(adirs.user_data_dir, *path)
-    return os.path.join(get_base_dir(), *path)
+    parts = _path_parts(path)
+    user_path = os.path.join(adirs.user_data_dir, *parts)
+    if os.path.exists(user_path):
+        return user_path
+    return os.path.join(get_base_dir(), *parts)
 
 
 def listdir(directory):
     """List all files in the given directory of the virtual filesystem"""
-    if not isdir(directory):
-        raise SystemError("No such directory: {}".format(directory))
+    parts = _path_parts(directory)
     ls = set()
-    if os.path.isdir(os.path.join(get_base_dir(), directory)):
-        ls.update(os.listdir(os.path.join(get_base_dir(), directory)))
-    if os.path.isdir(os.path.join(adirs.user_data_dir, directory)):
-        ls.update(os.listdir(os.path.join(adirs.user_data_dir, directory)))
+    found = False
+    for base in (get_base_dir(), adirs.user_data_dir):
+        try:
+            ls.update(os.listdir(os.path.join(base, *parts)))
+            found = True
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+    if not found:
+        raise SystemError("No such directory: {}".format(directory))
     return list(ls)
 
 
@@ -80,7 +90,8 @@ def get_contents(path):
     """Return the contents of a file in the virtual filesystem
 
     filename needs to use the UNIX style path separator('/')"""
-    if not isfile(path):
+    try:
+        with open(get_abs_path(path), "r") as f:
+            return f.read()
+    except FileNotFoundError:
         raise IOError("No such file: {}".format(path))
-    with open(get_abs_path(path), "r") as f:
-        return f.read()
@@ -14,24 +14,43 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.web.client import HTTPConnectionPool
 from twisted.logger import Logger
+from collections import OrderedDict
 import treq
 
 
 log = Logger()
 
+# cache of already shortened urls, least recently used entries get dropped
+_shorten_cache = OrderedDict()
+_SHORTEN_CACHE_MAX = 1024
+
+# keep connections to git.io open, so bursts of events don't need a new TLS
+# handshake for every url
+_pool = HTTPConnectionPool(reactor, persistent=True)
+_pool.maxPersistentPerHost = 8
+
 
 @defer.inlineCallbacks
 def shorten_github_url(url):
     """
     Shorten a github url using git.io - if it fails, return the original url
     """
+    if url in _shorten_cache:
+        _shorten_cache.move_to_end(url)
+        defer.returnValue(_shorten_cache[url])
     try:
         response = yield treq.post("https://git.io", data={"url": url},
-                                   timeout=5)
-        defer.returnValue(response.headers.getRawHeaders("Location", [url])[0])
+                                   pool=_pool, timeout=5)
+        short = response.headers.getRawHeaders("Location", [url])[0]
     except Exception as e:
         log.warn("Error shortening github url({url}): {error}",
                  url=url, error=e)
         defer.returnValue(url)
+    # failures are not cached, so they can be retried later
+    _shorten_cache[url] = short
+    if len(_shorten_cache) > _SHORTEN_CACHE_MAX:
+        _shorten_cache.popitem(last=False)
+    defer.returnValue(short)
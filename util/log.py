@@ -16,6 +16,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import os
@@ -64,24 +65,37 @@ def get_channellog_dir(config):
                                               "channellogs"))
 
 
-class YAMLFormatter(object):
+class DictFormatter(object):
     logged_fields = ["levelname", "levelno", "msg", "name"]
 
-    def format(self, record):
+    def to_dict(self, record):
         timestruct = time.localtime(record.created)
         d = {}
         d["time"] = time.strftime('%Y-%m-%d_%H:%M:%S', timestruct)
         d["timezone"] = time.tzname[timestruct.tm_isdst]
-        for field in YAMLFormatter.logged_fields:
+        for field in DictFormatter.logged_fields:
             d[field] = record.__dict__[field]
         d.update(record.__dict__["args"])
-        return yaml.dump(d, explicit_start=True, default_flow_style=False)
+        return d
+
+
+class YAMLFormatter(DictFormatter):
+    def format(self, record):
+        return yaml.dump(self.to_dict(record), explicit_start=True,
+                         default_flow_style=False)
+
+
+class JSONFormatter(DictFormatter):
+    """One JSON object per line (JSON Lines)"""
+    def format(self, record):
+        return json.dumps(self.to_dict(record))
 
 
 txt_formatter = logging.Formatter('%(asctime)s %(message)s')
 # dateformat for the formatter
 txt_formatter.datefmt = '%H:%M:%S'
 yaml_formatter = YAMLFormatter()
+json_formatter = JSONFormatter()
 logging.basicConfig(level=logging.INFO)
 
 
@@ -99,3 +113,11 @@ def yaml_namer(name):
     """
     index = name.rfind(".yaml")
     return name[:index] + name[index:].replace(".yaml", "") + ".yaml"
+
+
+def json_namer(name):
+    """
+    Remove the '.jsonl' in the middle and append it at the end
+    """
+    index = name.rfind(".jsonl")
+    return name[:index] + name[index:].replace(".jsonl", "") + ".jsonl"